@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 import os
-from typing import Tuple
+from typing import Optional, Tuple
 import errno
-import shutil
+import stat
 import click
-import tempfile
 import logclick as logging
 import storage
 
-from wrappers import _patch, _revert, _diff, PatchResult, PATCH_ERROR_REASONS
+from wrappers import _patch, _patch_batch, _revert, _diff, PatchResult, PATCH_ERROR_REASONS
 
 
 class TextStyle:
@@ -28,6 +27,9 @@ OK = f'{TextStyle.BOLD}{TextStyle.GREEN}\u2713{TextStyle.END}'
 NOTOK = f'{TextStyle.BOLD}{TextStyle.RED}\u2717{TextStyle.END}'
 WARN = f'{TextStyle.BOLD}{TextStyle.YELLOW}\u26a0{TextStyle.END}'
 VERBOSE = 0
+_CP_REFLINK = None # unknown until probed by _has_cp_reflink
+# -L follows symlinks like copytree does
+CP_ARGS = ('-a', '-L', '--reflink=auto', '-T')
 
 
 def _print_result(patch: str, rc: PatchResult = PatchResult.ERROR):
@@ -36,12 +38,64 @@ def _print_result(patch: str, rc: PatchResult = PatchResult.ERROR):
     elif rc == PatchResult.HUNK_SUCCEED:
         click.echo(f'{WARN} {patch} (Consider running dehunk command)')
     else:
-        click.echo(f'{NOTOK} {patch} ({PATCH_ERROR_REASONS[rc]})')
+        click.echo(f'{NOTOK} {patch} ({PATCH_ERROR_REASONS[rc.value]})')
+
+
+def _has_cp_reflink() -> bool:
+    """Probes once whether cp supports the flags used by _redeploy."""
+    import subprocess as sp
+    import tempfile
+    global _CP_REFLINK
+    if _CP_REFLINK is None:
+        with tempfile.TemporaryDirectory() as probe:
+            src = os.path.join(probe, 'src')
+            os.mkdir(src)
+            try:
+                p = sp.run(['cp', *CP_ARGS, src, os.path.join(probe, 'dst')],
+                           stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+                _CP_REFLINK = p.returncode == 0
+            except OSError:
+                _CP_REFLINK = False
+        logging.debug('cp --reflink=auto supported: %s', _CP_REFLINK)
+    return _CP_REFLINK
 
 
 def _redeploy(src: str, dst: str):
+    import shutil
+    import subprocess as sp
     shutil.rmtree(dst, ignore_errors=True)
-    shutil.copytree(src, dst)
+    if _has_cp_reflink():
+        # CoW snapshot where the filesystem supports it, plain copy otherwise
+        p = sp.run(['cp', *CP_ARGS, src, dst],
+                   stdout=sp.DEVNULL, stderr=sp.PIPE, text=True)
+        if p.returncode != 0:
+            raise OSError(f'failed to copy {src} to {dst}: {p.stderr.strip()}')
+        return
+
+    if not _link_tree(src, dst):
+        shutil.copytree(src, dst)
+
+
+def _link_tree(src: str, dst: str) -> bool:
+    import shutil
+    # copytree only reports failed links after walking the whole tree
+    if os.stat(src).st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        return False
+    # patch(1) writes modified files to new inodes, so hardlinks are safe
+    try:
+        shutil.copytree(src, dst, copy_function=os.link)
+        return True
+    except OSError:
+        shutil.rmtree(dst, ignore_errors=True)
+        return False
+
+
+def _snapshot(src: str, dst: str):
+    """Deploys a reference tree as hardlinks, copying only if linking fails."""
+    import shutil
+    shutil.rmtree(dst, ignore_errors=True)
+    if not _link_tree(src, dst):
+        _redeploy(src, dst)
 
 
 def init_dirs(tmpdir, source) -> Tuple[str, str]:
@@ -50,21 +104,33 @@ def init_dirs(tmpdir, source) -> Tuple[str, str]:
 
     def _isdirs_or_die(*directories):
         for directory in directories:
-            if not os.path.isdir(directory):
-                logging.error(f'{directory} not found')
+            try:
+                is_dir = stat.S_ISDIR(os.stat(directory).st_mode)
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                logging.error('%s not found', directory)
                 exit(errno.ENOENT)
-            logging.info(f'{directory} exists')
+            logging.info('%s exists', directory)
 
     dira, dirb = _make_pathes(tmpdir)
-    _redeploy(source, dira)
-    _redeploy(dira, dirb)
+    _snapshot(source, dira)
+    _redeploy(source, dirb)
     _isdirs_or_die(dira, dirb)
     return dira, dirb
 
 
-def at_tempdir(callback) -> int:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        return callback(tmpdir)
+def at_tempdir(callback, directory: str, cache: bool = False,
+               signature: Optional[str] = None) -> int:
+    import tempfile
+    if not cache:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            return callback(tmpdir, directory)
+    import cache as snapshots
+    with snapshots.cached_source(directory, _redeploy, signature) as (cache_dir, source):
+        # next to the cached snapshot, so it can be hardlinked
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tmpdir:
+            return callback(tmpdir, source)
 
 
 @click.group()
@@ -76,66 +142,132 @@ def cli(verbose: int):
 
 
 @cli.command()
-@click.option('-C', '--directory', default=os.getcwd(),
+@click.option('-C', '--directory', default='.',
               type=click.Path(exists=True, file_okay=False),
               help='Path to project directory')
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1),
+              help='Apply up to N patches concurrently (patches must not overlap)')
+@click.option('--cache', is_flag=True,
+              help='Reuse a snapshot of the project directory and results between runs')
 @click.argument('patches', nargs=-1,
                 type=click.Path(exists=True, dir_okay=False))
-def apply(directory: str, patches):
+def apply(directory: str, jobs: int, cache: bool, patches):
     """Tries to apply patches."""
-    def do_apply(tmpdir) -> int:
+    results = []
+    def _report(patch: str, rc: PatchResult):
+        results.append(rc)
+        _print_result(patch, rc)
+
+    project, signature, key = None, None, None
+    if cache and patches:
+        import cache as snapshots
+        project = snapshots.project_key(directory)
+        signature = snapshots.tree_signature(directory)
+        key = snapshots.results_key(signature, patches, jobs > 1)
+        rcs = snapshots.load_results(project, key)
+        if rcs is not None:
+            logging.info('%s unchanged, using cached results', directory)
+            snapshots.prune(project)
+            rcs = [PatchResult(rc) for rc in rcs]
+            for patch, rc in zip(patches, rcs):
+                _print_result(patch, rc)
+            exit(sum(not rc.is_ok() for rc in rcs))
+
+    def do_apply(tmpdir, source) -> int:
         fails = 0
-        dira, dirb = init_dirs(tmpdir, directory)
+        dira, dirb = init_dirs(tmpdir, source)
+
+        if len(patches) > 1:
+            # a single patch(1) run for the common all-clean case
+            if _patch_batch(dirb, patches, ['-d']) == PatchResult.OK:
+                for patch in patches:
+                    _report(patch, PatchResult.OK)
+                return fails
+            # locate the offending patches one by one
+            _redeploy(dira, dirb)
+
+        if jobs > 1:
+            # disjoint patches only, so the tree is never redeployed here
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                rcs = executor.map(lambda patch: _patch(dirb, patch, ['-d']), patches)
+                for patch, rc in zip(patches, rcs):
+                    _report(patch, rc)
+                    if not rc.is_ok():
+                        fails += 1
+            return fails
 
         for patch in patches:
             rc = _patch(dirb, patch, ['-d'])
-            _print_result(patch, rc)
+            _report(patch, rc)
             if not rc.is_ok():
                 fails += 1
                 _redeploy(dira, dirb)
         return fails
 
-    exit(at_tempdir(do_apply))
+    fails = at_tempdir(do_apply, directory, cache, signature)
+    if key is not None:
+        snapshots.store_results(project, signature, key, [rc.value for rc in results])
+    exit(fails)
 
 
 @cli.command()
-@click.option('-C', '--directory', default=os.getcwd(),
+@click.option('-C', '--directory', default='.',
               type=click.Path(exists=True, file_okay=False),
               help='Path to project directory')
+@click.option('--cache', is_flag=True,
+              help='Reuse a snapshot of the project directory between runs')
 @click.argument('patches', nargs=-1,
                 type=click.Path(exists=True, dir_okay=False))
-def dehunk(directory: str, patches):
+def dehunk(directory: str, cache: bool, patches):
     """Excludes succesful hunks in patches."""
-    def do_dehunk(tmpdir) -> int:
+    def do_dehunk(tmpdir, source) -> int:
+        import shutil
         fails = 0
-        dira, dirb = init_dirs(tmpdir, directory)
+        dira, dirb = init_dirs(tmpdir, source)
         applied = []
 
         for patch in patches:
             rc = _patch(dirb, patch, ['-d'])
             _print_result(patch, rc)
             if rc == PatchResult.HUNK_SUCCEED:
-                shutil.copyfile(patch, patch + '.orig') # with hunks to .orig
+                # with hunks to .orig, through symlinks made by relink
+                real_patch = os.path.realpath(patch)
+                backup = patch + '.orig'
+                if os.path.lexists(backup):
+                    os.remove(backup)
+                try:
+                    os.link(real_patch, backup)
+                except OSError:
+                    shutil.copyfile(real_patch, backup)
                 # apply previous applied patch
                 for applied_patch in applied:
                     _patch(dira, applied_patch, ['-d'])
 
                 # create dehunked patch
+                dehunked = real_patch + '.dehunked'
                 old_pwd = os.getcwd()
                 os.chdir(tmpdir)
-                dehunked = _diff('a', 'b', ['-x', '*.orig'])
-                os.chdir(old_pwd)
-
-                if dehunked is None:
-                    logging.fatal(f'Failed to dehunk {patch}')
+                try:
+                    is_diffed = _diff('a', 'b', ['-x', '*.orig'], dehunked)
+                except BaseException:
+                    if os.path.exists(dehunked):
+                        os.remove(dehunked)
+                    raise
+                finally:
+                    os.chdir(old_pwd)
+
+                if not is_diffed:
+                    os.remove(dehunked)
+                    logging.fatal('Failed to dehunk %s', patch)
                     exit(fails)
-                with open(patch, 'w') as p:
-                    p.write(dehunked)
+                shutil.copymode(real_patch, dehunked)
+                os.replace(dehunked, real_patch)
 
-                _redeploy(directory, dira)
+                _snapshot(source, dira)
                 applied.append(patch)
             elif rc == PatchResult.OK:
-                logging.warn(f'no hunks for {patch} -- SKIP')
+                logging.warn('no hunks for %s -- SKIP', patch)
                 applied.append(patch)
             else:
                 fails += 1
@@ -143,18 +275,18 @@ def dehunk(directory: str, patches):
                 _redeploy(dira, dirb)
         return fails
 
-    exit(at_tempdir(do_dehunk))
+    exit(at_tempdir(do_dehunk, directory, cache))
 
 
 @cli.command()
-@click.option('-C', '--directory', default=os.getcwd(),
+@click.option('-C', '--directory', default='.',
               type=click.Path(exists=True, file_okay=False, writable=True),
               help='Patched directory')
 @click.argument('patches', nargs=-1, type=click.Path(exists=True, dir_okay=False))
 def revert(directory: str, patches: list[str]):
     """Reverts patches."""
     for patch in reversed(patches):
-        logging.command(f'reverting {patch}...')
+        logging.command('reverting %s...', patch)
         rc = _revert(directory, patch, ['-d'])
         _print_result(patch, rc)
         if not rc.is_ok():
@@ -162,7 +294,7 @@ def revert(directory: str, patches: list[str]):
 
 
 @cli.command()
-@click.option('-C', '--project', default=os.getcwd(), help='Project directory',
+@click.option('-C', '--project', default='.', help='Project directory',
                 type=click.Path(exists=True, file_okay=False, writable=True))
 def init(project: str):
     '''Initializes patches storage'''
@@ -181,7 +313,7 @@ def check_storage(project_root: str):
 
 
 @cli.command()
-@click.option('-C', '--project', default=os.getcwd(), help='Project directory',
+@click.option('-C', '--project', default='.', help='Project directory',
                 type=click.Path(exists=True, file_okay=False, writable=True))
 @click.argument('patches', nargs=-1, type=click.Path())
 def postpone(project: str, patches: list[str]):
@@ -196,7 +328,7 @@ def postpone(project: str, patches: list[str]):
 
 
 @cli.command()
-@click.option('-C', '--project', default=os.getcwd(), help='Project directory',
+@click.option('-C', '--project', default='.', help='Project directory',
                 type=click.Path(exists=True, file_okay=False, writable=True))
 def relink(project: str):
     '''Symlinks committed patches to project directory'''
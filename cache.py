@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import closing, contextmanager
+from typing import Callable, Iterator, Optional, Tuple
+
+import logclick as logging
+
+
+CACHE_ROOT = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                          'patchiman')
+CACHE_MAX_AGE = 30 * 24 * 60 * 60 # seconds a snapshot may stay unused
+
+
+def project_key(source: str) -> str:
+    return hashlib.sha1(os.path.abspath(source).encode(errors='surrogateescape')).hexdigest()
+
+
+def tree_signature(root: str) -> str:
+    """Hashes every file a deploy of root copies, following symlinks like cp -L."""
+    digest = hashlib.sha1()
+    visited = set()
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        # real path covers retargeted symlinks to directories
+        rel = os.path.relpath(dirpath, root)
+        digest.update(f'{rel}/\0{os.path.realpath(dirpath)}\n'.encode(errors='surrogateescape'))
+        st = os.stat(dirpath)
+        if (st.st_dev, st.st_ino) in visited:
+            dirnames.clear() # symlink loop or already hashed
+            continue
+        visited.add((st.st_dev, st.st_ino))
+
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+                entry = f'{os.path.join(rel, name)}\0{st.st_size}\0{st.st_mtime_ns}\n'
+            except FileNotFoundError: # dangling symlink
+                entry = f'{os.path.join(rel, name)}\0-> {os.readlink(path)}\n'
+            digest.update(entry.encode(errors='surrogateescape'))
+    return digest.hexdigest()
+
+
+def _lock(cache_dir: str, operation: int):
+    """Opens and flocks cache_dir/lock, retrying if it was pruned meanwhile.
+
+    Returns None if a non-blocking operation would block.
+    """
+    lock_path = os.path.join(cache_dir, 'lock')
+    while True:
+        os.makedirs(cache_dir, exist_ok=True)
+        lock = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock, operation)
+        except BlockingIOError:
+            lock.close()
+            return None
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                os.utime(lock_path) # marks the snapshot as recently used
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def _is_fresh(stamp: str, signature: str) -> bool:
+    try:
+        with open(stamp) as f:
+            return f.read() == signature
+    except OSError:
+        return False
+
+
+def prune(keep: str):
+    """Removes caches of projects other than keep unused for CACHE_MAX_AGE."""
+    os.makedirs(CACHE_ROOT, exist_ok=True)
+    with os.scandir(CACHE_ROOT) as entries:
+        stale = [entry.path for entry in entries
+                 if entry.is_dir(follow_symlinks=False) and entry.name != keep]
+    pruned = []
+    for cache_dir in stale:
+        lock_path = os.path.join(cache_dir, 'lock')
+        try:
+            with open(lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if time.time() - os.fstat(lock.fileno()).st_mtime > CACHE_MAX_AGE:
+                    logging.info('pruning stale cache %s', cache_dir)
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                    pruned.append(os.path.basename(cache_dir))
+        except OSError: # in use by another run or not ours
+            continue
+    if pruned:
+        _forget_results(pruned)
+
+
+def _rebuild(cache_dir: str, source: str, signature: str, deploy: Callable[[str, str], None]):
+    """Refreshes cache_dir/a if it is stale. Needs the exclusive lock held."""
+    snapshot = os.path.join(cache_dir, 'a')
+    stamp = os.path.join(cache_dir, 'signature')
+
+    # nobody else holds the lock, so anything else here is left over
+    with os.scandir(cache_dir) as entries:
+        leftovers = [entry.path for entry in entries
+                     if entry.name not in ('a', 'signature', 'lock')]
+    for leftover in leftovers:
+        logging.info('removing leftover %s', leftover)
+        if os.path.isdir(leftover) and not os.path.islink(leftover):
+            shutil.rmtree(leftover, ignore_errors=True)
+        else:
+            os.remove(leftover)
+
+    if _is_fresh(stamp, signature):
+        logging.info('%s unchanged, using cached %s', source, snapshot)
+        return
+
+    logging.info('caching %s to %s', source, snapshot)
+    if os.path.exists(stamp):
+        os.remove(stamp) # never trust a half-written snapshot
+    build = tempfile.mkdtemp(prefix='build.', dir=cache_dir)
+    deploy(source, build)
+    old = None
+    if os.path.exists(snapshot):
+        old = tempfile.mkdtemp(prefix='old.', dir=cache_dir)
+        os.replace(snapshot, os.path.join(old, 'a'))
+    os.replace(build, snapshot)
+    with open(stamp + '.tmp', 'w') as f:
+        f.write(signature)
+    os.replace(stamp + '.tmp', stamp)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+@contextmanager
+def cached_source(source: str, deploy: Callable[[str, str], None],
+                  signature: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """Yields the cache directory and an up to date snapshot of source in it.
+
+    The snapshot is rebuilt with deploy only under an exclusive lock, and a
+    shared lock is held until the caller is done with it, so it never changes
+    under a run.
+    """
+    key = project_key(source)
+    cache_dir = os.path.join(CACHE_ROOT, key)
+    snapshot = os.path.join(cache_dir, 'a')
+    stamp = os.path.join(cache_dir, 'signature')
+
+    if signature is None:
+        signature = tree_signature(source)
+    prune(key)
+
+    is_exclusive = True
+    lock = _lock(cache_dir, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    if lock is None:
+        # other runs are using the snapshot, share it while it is fresh
+        is_exclusive = False
+        lock = _lock(cache_dir, fcntl.LOCK_SH)
+        if not _is_fresh(stamp, signature):
+            lock.close()
+            is_exclusive = True
+            lock = _lock(cache_dir, fcntl.LOCK_EX)
+
+    with lock:
+        if is_exclusive:
+            _rebuild(cache_dir, source, signature, deploy)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        else:
+            logging.info('%s unchanged, using cached %s', source, snapshot)
+        yield cache_dir, snapshot
+
+
+def results_key(signature: str, patches, *extra) -> str:
+    digest = hashlib.sha1(signature.encode())
+    for patch in patches:
+        with open(patch, 'rb') as f:
+            # length prefixed, patches may contain any bytes
+            digest.update(os.fstat(f.fileno()).st_size.to_bytes(8, 'little'))
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
+def _results_db() -> sqlite3.Connection:
+    os.makedirs(CACHE_ROOT, exist_ok=True)
+    db = sqlite3.connect(os.path.join(CACHE_ROOT, 'results.sqlite'))
+    db.execute('CREATE TABLE IF NOT EXISTS apply_results ('
+               'project TEXT NOT NULL, signature TEXT NOT NULL, key TEXT NOT NULL, '
+               'rcs TEXT NOT NULL, PRIMARY KEY (project, key))')
+    return db
+
+
+def load_results(project: str, key: str) -> Optional[list[int]]:
+    with closing(_results_db()) as db:
+        row = db.execute('SELECT rcs FROM apply_results WHERE project = ? AND key = ?',
+                         (project, key)).fetchone()
+    if row is None:
+        return None
+    return [int(rc) for rc in row[0].split(',')]
+
+
+def store_results(project: str, signature: str, key: str, rcs: list[int]):
+    with closing(_results_db()) as db, db:
+        # results for older states of the tree can never be hit again
+        db.execute('DELETE FROM apply_results WHERE project = ? AND signature != ?',
+                   (project, signature))
+        db.execute('INSERT OR REPLACE INTO apply_results VALUES (?, ?, ?, ?)',
+                   (project, signature, key, ','.join(str(rc) for rc in rcs)))
+
+
+def _forget_results(projects: list[str]):
+    with closing(_results_db()) as db, db:
+        db.executemany('DELETE FROM apply_results WHERE project = ?',
+                       [(project,) for project in projects])
@@ -22,36 +22,43 @@ class LogClickLevel(IntEnum):
 
 
 _LOG_LEVEL = LogClickLevel.WARNING
+# bit N is set when level N is printed
+_ENABLED_MASK = (1 << (_LOG_LEVEL + 1)) - 1
 
 
 def set_loglevel(level: LogClickLevel):
-    global _LOG_LEVEL
+    global _LOG_LEVEL, _ENABLED_MASK
     _LOG_LEVEL = level
+    _ENABLED_MASK = (1 << (level + 1)) - 1
 
 def get_loglevel() -> LogClickLevel:
     return _LOG_LEVEL
 
-def _log_common(text: str, level: LogClickLevel):
-    if get_loglevel() >= level:
-        click.echo(f'[{level.name}]: {text}')
+def is_enabled(level: LogClickLevel) -> bool:
+    return _ENABLED_MASK & (1 << level) != 0
 
-def debug(text: str):
-    _log_common(text, LogClickLevel.DEBUG)
+def _log_common(level: LogClickLevel, fmt: str, args: tuple):
+    # format only messages that are going to be printed
+    if _ENABLED_MASK & (1 << level):
+        click.echo(f'[{level.name}]: {fmt % args if args else fmt}')
 
-def command(text: str):
-    _log_common(text, LogClickLevel.CMD)
+def debug(fmt: str, *args):
+    _log_common(LogClickLevel.DEBUG, fmt, args)
 
-def subcommand(text: str):
-    _log_common(text, LogClickLevel.SUBCMD)
+def command(fmt: str, *args):
+    _log_common(LogClickLevel.CMD, fmt, args)
 
-def info(text: str):
-    _log_common(text, LogClickLevel.INFO)
+def subcommand(fmt: str, *args):
+    _log_common(LogClickLevel.SUBCMD, fmt, args)
 
-def warn(text: str):
-    _log_common(text, LogClickLevel.WARNING)
+def info(fmt: str, *args):
+    _log_common(LogClickLevel.INFO, fmt, args)
 
-def error(text: str):
-    _log_common(text, LogClickLevel.ERROR)
+def warn(fmt: str, *args):
+    _log_common(LogClickLevel.WARNING, fmt, args)
 
-def fatal(text: str):
-    _log_common(text, LogClickLevel.FATAL)
\ No newline at end of file
+def error(fmt: str, *args):
+    _log_common(LogClickLevel.ERROR, fmt, args)
+
+def fatal(fmt: str, *args):
+    _log_common(LogClickLevel.FATAL, fmt, args)
\ No newline at end of file
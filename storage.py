@@ -1,7 +1,6 @@
 #!/usr/bin/python3
-import shutil
 import os
-from typing import Tuple
+from typing import Iterator, Tuple
 from enum import Enum
 
 import logclick as logging
@@ -34,9 +33,11 @@ def test(project_root: str) -> Tuple[bool, str]:
 
 
 def relink(project_root: str) -> Tuple[bool, str]:
-    def _find_patches(folder: str) -> map:
-        return map(lambda patch: os.path.join(folder, patch),
-                   filter(_is_patch, os.listdir(folder)))
+    def _find_patches(folder: str) -> Iterator[str]:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if _is_patch(entry.name):
+                    yield entry.path
 
     for patch in _find_patches(project_root):
         try:
@@ -58,16 +59,18 @@ def relink(project_root: str) -> Tuple[bool, str]:
 
 
 def init(project_root: str) -> Tuple[bool, str]:
+    import shutil
     storage_path = _storage_path(project_root)
     shutil.rmtree(storage_path, ignore_errors=True)
     for patches_category in PatchesCategories:
         category_path = os.path.join(storage_path, patches_category.value)
         os.makedirs(category_path)
-        logging.subcommand(f'{patches_category} initialized')
+        logging.subcommand('%s initialized', patches_category)
     return True, ''
 
 
 def postpone(project_root: str, patch: str) -> Tuple[bool, str]:
+    import shutil
     storage_path = _storage_path(project_root)
     original_path = os.path.join(storage_path, 'original', patch)
     postponed_path = os.path.join(storage_path, 'postponed', patch)
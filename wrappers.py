@@ -1,12 +1,14 @@
 import enum
+import os
 import re
-from typing import Optional
-import subprocess as sp
 import logclick as logging
 
 
+RE_PARTLY_SUCCEEDED = re.compile(r'(patching\s*.*\n(Hunk\s*#\d+\s*succeeded.*\n)?){2,}')
+STDERR_TAIL_SIZE = 8192
 
-class PatchResult(enum.Enum):
+
+class PatchResult(enum.IntEnum):
     OK = 0
     REVERSE_APPLIED = 1
     HUNK_SUCCEED = 2
@@ -20,59 +22,144 @@ class PatchResult(enum.Enum):
         return self == PatchResult.OK or self == PatchResult.HUNK_SUCCEED
 
 
-PATCH_ERROR_REASONS = {
-    PatchResult.REVERSE_APPLIED: 'Already applied',
-    PatchResult.HUNK_FAILED: 'Hunk failed',
-    PatchResult.INVALID_FORMAT: 'Invalid format',
-    PatchResult.FILE_NOT_FOUND: 'Can\'t find file to patch',
-    PatchResult.EOF: 'Unexpected end of patch',
-    PatchResult.ERROR: 'Error',
-}
+# indexed by PatchResult value
+PATCH_ERROR_REASONS = (
+    'OK',
+    'Already applied',
+    'Hunk succeeded',
+    'Hunk failed',
+    'Invalid format',
+    'Can\'t find file to patch',
+    'Unexpected end of patch',
+    'Error',
+)
+
+
+def _log_cmd(cmd: list[str]):
+    if logging.is_enabled(logging.LogClickLevel.SUBCMD):
+        logging.subcommand(' '.join([cmd[0].upper()] + cmd[1:]))
 
 
-def _diff(a: str, b: str, extra_args: list[str]) -> Optional[str]:
+def _log_streams(**streams: str):
+    # skip stripping possibly huge outputs nobody will see
+    if logging.is_enabled(logging.LogClickLevel.SUBCMD):
+        for name, text in streams.items():
+            logging.subcommand('%s: %s', name, text.strip())
+
+
+def _diff(a: str, b: str, extra_args: list[str], output: str) -> bool:
+    import subprocess as sp
     cmd = ['diff', '-updrN', *extra_args, a, b]
-    logging.subcommand(' '.join([cmd[0].upper()] + cmd[1:]))
-    p = sp.Popen(cmd,
-                 stdout=sp.PIPE, stderr=sp.PIPE, text=True)
-    stdout, stderr = p.communicate()
-    logging.subcommand(f'stdout: {stdout.strip()}')
-    logging.subcommand(f'stderr: {stderr.strip()}')
-    return stdout if p.returncode != 2 else None
+    _log_cmd(cmd)
+    with open(output, 'wb') as f:
+        p = sp.Popen(cmd,
+                     stdout=f, stderr=sp.PIPE, text=True)
+        _, stderr = p.communicate()
+    _log_streams(stderr=stderr)
+    return p.returncode != 2
 
 
-def _patch(target: str, patch: str, extra_args: list[str]) -> PatchResult:
-    cmd = ['patch', '-p1', '-F0', *extra_args, target]
-    logging.subcommand(' '.join([cmd[0].upper()] + cmd[1:]))
-    p = sp.Popen(cmd,
-                 stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    stdout, stderr = '', ''
-    with open(patch, 'rb') as f:
-        stdout, stderr = p.communicate(input=f.read())
-        stdout, stderr = stdout.decode(), stderr.decode()
-    logging.subcommand(f'stdout: {stdout.strip()}')
-    logging.subcommand(f'stderr: {stderr.strip()}')
-    if p.returncode == 0:
-        if re.search('Hunk\s*#\d+\s*succeeded', stdout) is not None:
+def _patch_result(returncode: int, stdout: str, stderr: str) -> PatchResult:
+    if returncode == 0:
+        if 'Hunk #' in stdout and ' succeeded at ' in stdout:
             return PatchResult.HUNK_SUCCEED
         return PatchResult.OK
 
-    if 'patch: ****' in stderr:
-        is_gibberish = 'Only garbage was found in the patch input.' in stderr
-        is_malformed = 'malformed patch at' in stderr
+    # patch(1) exits right after a fatal error, so it is always at the end
+    stderr_tail = stderr[-STDERR_TAIL_SIZE:]
+    if 'patch: ****' in stderr_tail:
+        is_gibberish = 'Only garbage was found in the patch input.' in stderr_tail
+        is_malformed = 'malformed patch at' in stderr_tail
         if is_gibberish or is_malformed:
             return PatchResult.INVALID_FORMAT
-        elif 'unexpected end of file in patch' in stderr:
+        elif 'unexpected end of file in patch' in stderr_tail:
             return PatchResult.EOF
         return PatchResult.ERROR
 
-    is_partly_succeeded = re.search('(patching\s*.*\n(Hunk\s*#\d+\s*succeeded.*\n)?){2,}', stdout) is not None
-    is_hunk_failed = re.search('Hunk\s*#\d+\s*FAILED', stdout) is not None
+    # cheap substring checks first, the multi-line regex only when undecided
     if 'Assume -R' in stdout:
-        return PatchResult.HUNK_FAILED if is_partly_succeeded else PatchResult.REVERSE_APPLIED
+        rc = PatchResult.REVERSE_APPLIED
     elif 'can\'t find file to patch' in stdout:
-        return PatchResult.HUNK_FAILED if is_partly_succeeded else PatchResult.FILE_NOT_FOUND
-    return PatchResult.HUNK_FAILED if is_hunk_failed or is_partly_succeeded else PatchResult.ERROR
+        rc = PatchResult.FILE_NOT_FOUND
+    elif 'Hunk #' in stdout and ' FAILED at ' in stdout:
+        return PatchResult.HUNK_FAILED
+    else:
+        rc = PatchResult.ERROR
+    is_partly_succeeded = RE_PARTLY_SUCCEEDED.search(stdout) is not None
+    return PatchResult.HUNK_FAILED if is_partly_succeeded else rc
+
+
+def _patch(target: str, patch: str, extra_args: list[str]) -> PatchResult:
+    import subprocess as sp
+    cmd = ['patch', '-p1', '-F0', *extra_args, target]
+    _log_cmd(cmd)
+    with open(patch, 'rb') as f:
+        p = sp.Popen(cmd,
+                     stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
+        stdout, stderr = p.communicate()
+    stdout, stderr = stdout.decode(), stderr.decode()
+    _log_streams(stdout=stdout, stderr=stderr)
+    return _patch_result(p.returncode, stdout, stderr)
+
+
+def _patch_batch(target: str, patches: list[str], extra_args: list[str]) -> PatchResult:
+    """Applies all patches as one concatenated stream in a single patch(1) run.
+
+    OK is returned only if every patch contributed file diffs and patch(1)
+    processed all of them, because patch(1) silently skips leading garbage
+    when a valid diff follows it in the stream.
+    """
+    import subprocess as sp
+    import threading
+
+    headers = []
+    errors = []
+    def _feed(fd: int, p: sp.Popen):
+        with open(fd, 'wb') as pipe:
+            try:
+                for patch in patches:
+                    count = 0
+                    with open(patch, 'rb') as f:
+                        for line in f:
+                            if line.startswith(b'+++ '):
+                                count += 1
+                            pipe.write(line)
+                    headers.append(count)
+            except BrokenPipeError:
+                pass
+            except BaseException as e:
+                # do not let patch(1) apply a truncated stream
+                errors.append(e)
+                p.kill()
+
+    cmd = ['patch', '-p1', '-F0', *extra_args, target]
+    _log_cmd(cmd)
+    r, w = os.pipe()
+    try:
+        p = sp.Popen(cmd,
+                     stdin=r, stdout=sp.PIPE, stderr=sp.PIPE)
+    except BaseException:
+        os.close(w)
+        raise
+    finally:
+        os.close(r)
+    feeder = threading.Thread(target=_feed, args=(w, p))
+    feeder.start()
+    stdout, stderr = p.communicate()
+    feeder.join()
+    if errors:
+        raise errors[0]
+    stdout, stderr = stdout.decode(), stderr.decode()
+    _log_streams(stdout=stdout, stderr=stderr)
+
+    rc = _patch_result(p.returncode, stdout, stderr)
+    is_complete = len(headers) == len(patches) and all(headers) \
+        and sum(headers) == stdout.count('patching file ')
+    if rc == PatchResult.OK and not is_complete:
+        logging.info('batch output does not cover every patch')
+        return PatchResult.ERROR
+    return rc
+
 
 def _revert(target: str, patch: str, extra_args: list[str]) -> PatchResult:
     return _patch(target, patch, ['-R', *extra_args])